@@ -1,98 +1,413 @@
 import os
+import mmap
+import pickle
+import hashlib
+import re
 import sys
 import argparse
-import sqlparse
+from concurrent.futures import ProcessPoolExecutor
 
-def process_schema(directory_path):
+_intern = sys.intern
+
+# Version prefix of a Flyway migration file name, e.g. V1.2.3__Desc.sql or V1_2__Desc.sql
+_FLYWAY_VERSION_RE = re.compile(r'[Vv]([0-9]+(?:[._][0-9]+)*)_')
+# Cheap check run on the raw bytes before any decoding or parsing
+_DDL_PREFILTER_RE = re.compile(rb'create\s+(?:temp(?:orary)?\s+)?table|alter\s+table', re.I)
+# One statement in the raw bytes, up to and including its ';'. Semicolons inside strings, quoted
+# identifiers and comments do not end a statement; an unterminated quote is taken as a single character.
+_STATEMENT_RE = re.compile(
+    rb'''(?:[^;'"`\[/-]+|'[^']*'|"[^"]*"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*.*?(?:\*/|\Z)|[/'"`\[-])*;?''',
+    re.S,
+)
+# Whitespace and comments between tokens
+_WS_RE = re.compile(r'(?:\s+|--[^\n]*|/\*.*?(?:\*/|\Z))*', re.S)
+_WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_$]*')
+# Plain "name TYPE[(args)] [modifiers]" column definition, tried before the general rules. It fails when
+# a group or quote follows the type (e.g. ENUM('x', 'y')), so such columns take the general path instead
+_SIMPLE_COLUMN_RE = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_$]*)\s+([A-Za-z_][A-Za-z0-9_$]*(?![A-Za-z0-9_$])(?:\s*\([^()\'"]*\))?)(?!\s*[(\'"])[^,()\'"`\[;/-]*')
+# A run of characters that cannot start a string, comment or group, or else any single character
+_SKIP_RE = re.compile(r'[^\'"`\[(),;/-]+|.', re.S)
+# Closing character for each kind of quoted identifier, and for string literals when skipping
+_IDENT_QUOTES = {'"': '"', '`': '`', '[': ']'}
+_SKIP_QUOTES = {**_IDENT_QUOTES, "'": "'"}
+# Leading keywords of table-level constraints, which are not columns
+_CONSTRAINT_KEYWORDS = frozenset(('CONSTRAINT', 'PRIMARY', 'FOREIGN', 'UNIQUE', 'CHECK', 'KEY', 'INDEX'))
+# Constraint keywords that are also legal column names, e.g. in settings or key/value tables
+_AMBIGUOUS_KEYWORDS = frozenset(('KEY', 'INDEX'))
+
+# Parsed results of each file are cached here across runs, keyed by content hash.
+# Bump _CACHE_VERSION whenever the shape or meaning of the parse results changes.
+_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'dbviz')
+_CACHE_VERSION = 5
+_CACHE_MAX_BYTES = 64 << 20
+
+class ParseError(Exception):
+    pass
+
+class Parser:
+    # Recursive descent parser for the SQL subset dbviz understands:
+    #
+    #   CREATE [TEMP | TEMPORARY] TABLE [IF NOT EXISTS] name (column type [...], [table constraint], ...) [...];
+    #   ALTER TABLE [IF EXISTS] [ONLY] name ADD [COLUMN] [IF NOT EXISTS] column type [...], [other action], ...;
+    #
+    # Names may be schema-qualified and quoted with "", `` or []. A type is a name plus an optional
+    # argument list, e.g. VARCHAR(255). Anything else after a column's type (constraints, defaults) is
+    # ignored, and any other statement, or one that does not fit the grammar, is skipped up to its ';'.
+    # Results are emitted directly as the (statement_type, table_name, columns_or_changes) tuples
+    # returned by _parse_file, without building an AST.
+
+    def __init__(self, src):
+        self.src = src
+        self.pos = 0
+
+    def skip_ws(self):
+        self.pos = _WS_RE.match(self.src, self.pos).end()
+
+    def peek_keyword(self):
+        # Upper-cased word at the current position, or None
+        self.skip_ws()
+        match = _WORD_RE.match(self.src, self.pos)
+        return match.group().upper() if match else None
+
+    def accept(self, *keywords):
+        # Consume the keyword sequence if it comes next, otherwise leave the position unchanged
+        start = self.pos
+        for keyword in keywords:
+            if self.peek_keyword() != keyword:
+                self.pos = start
+                return False
+            self.pos += len(keyword)
+        return True
+
+    def expect(self, keyword):
+        if not self.accept(keyword):
+            raise ParseError(f'Expected {keyword} at offset {self.pos}')
+
+    def accept_char(self, char):
+        self.skip_ws()
+        if self.src.startswith(char, self.pos):
+            self.pos += 1
+            return True
+        return False
+
+    def expect_char(self, char):
+        if not self.accept_char(char):
+            raise ParseError(f'Expected {char!r} at offset {self.pos}')
+
+    def ident(self):
+        # Plain or quoted identifier; a schema-qualified name yields its last part
+        name = self._name_part()
+        while self.src.startswith('.', self.pos):
+            self.pos += 1
+            name = self._name_part()
+        return _intern(name)
+
+    def _name_part(self):
+        self.skip_ws()
+        src, pos = self.src, self.pos
+        if src[pos:pos + 1] in _IDENT_QUOTES:
+            end = src.find(_IDENT_QUOTES[src[pos]], pos + 1)
+            if end < 0:
+                raise ParseError(f'Unterminated identifier at offset {pos}')
+            self.pos = end + 1
+            return src[pos + 1:end]
+        match = _WORD_RE.match(src, pos)
+        if not match:
+            raise ParseError(f'Expected identifier at offset {pos}')
+        self.pos = match.end()
+        return match.group()
+
+    def at_table_constraint(self):
+        # Whether a table constraint rather than a column definition comes next. KEY and INDEX only start
+        # a constraint when followed by "(" or "name (", and in the latter case the group must not look like
+        # type arguments, so "key VARCHAR(20)" and "index NUMERIC(10, 2)" stay columns
+        keyword = self.peek_keyword()
+        if keyword not in _CONSTRAINT_KEYWORDS:
+            return False
+        if keyword not in _AMBIGUOUS_KEYWORDS:
+            return True
+        start = self.pos
+        self.pos += len(keyword)
+        try:
+            if self.accept_char('('):
+                return True
+            self._name_part()
+            if not self.accept_char('('):
+                return False
+            self.skip_ws()
+            return self.src[self.pos:self.pos + 1] not in "0123456789'"
+        except ParseError:
+            return False
+        finally:
+            self.pos = start
+
+    def type_expr(self):
+        # Type name plus an optional balanced argument list, e.g. DECIMAL(10, 2); None if there is no type
+        self.skip_ws()
+        match = _WORD_RE.match(self.src, self.pos)
+        if not match:
+            return None
+        self.pos = match.end()
+        if self.accept_char('('):
+            self.skip_until(')')
+            self.expect_char(')')
+            return _intern(self.src[match.start():self.pos])
+        self.pos = match.end()
+        return _intern(match.group())
+
+    def skip_until(self, stops):
+        # Advance to the next top-level character in stops, stepping over strings, comments and nested groups
+        src = self.src
+        while True:
+            self.skip_ws()
+            pos = self.pos
+            if pos >= len(src):
+                return
+            char = src[pos]
+            if char in stops:
+                return
+            if char == '(':
+                self.pos += 1
+                self.skip_until(')')
+                self.pos += 1
+            elif char in _SKIP_QUOTES:
+                end = src.find(_SKIP_QUOTES[char], pos + 1)
+                self.pos = end + 1 if end >= 0 else len(src)
+            else:
+                self.pos = _SKIP_RE.match(src, pos).end()
+
+    def parse_create(self):
+        self.expect('CREATE')
+        if not self.accept('TEMPORARY'):
+            self.accept('TEMP')
+        self.expect('TABLE')
+        self.accept('IF', 'NOT', 'EXISTS')
+        table_name = self.ident()
+        self.expect_char('(')
+        names = []
+        types = []
+        while not self.accept_char(')'):
+            if not self.at_table_constraint():
+                match = _SIMPLE_COLUMN_RE.match(self.src, self.pos)
+                if match:
+                    names.append(_intern(match.group(1)))
+                    types.append(_intern(match.group(2)))
+                    self.pos = match.end()
+                else:
+                    column_name = self.ident()
+                    column_type = self.type_expr()
+                    if column_type:
+                        names.append(column_name)
+                        types.append(column_type)
+            self.skip_until(',);')
+            if not self.accept_char(','):
+                self.expect_char(')')
+                break
+        return 'CREATE', table_name, (names, types)
+
+    def parse_alter(self):
+        self.expect('ALTER')
+        self.expect('TABLE')
+        self.accept('IF', 'EXISTS')
+        self.accept('ONLY')
+        table_name = self.ident()
+        changes = []
+        while True:
+            if self.accept('ADD'):
+                # After an explicit COLUMN, even a name like KEY or INDEX is a column
+                explicit_column = self.accept('COLUMN')
+                self.accept('IF', 'NOT', 'EXISTS')
+                if explicit_column or not self.at_table_constraint():
+                    column_name = self.ident()
+                    column_type = self.type_expr()
+                    if column_type:
+                        changes.append((column_name, column_type))
+            self.skip_until(',;')
+            if not self.accept_char(','):
+                break
+        return 'ALTER', table_name, changes
+
+    def parse_statement(self):
+        # Parse the statement at the current position, or return None if it is outside the supported subset
+        keyword = self.peek_keyword()
+        start = self.pos
+        try:
+            if keyword == 'CREATE':
+                return self.parse_create()
+            if keyword == 'ALTER':
+                return self.parse_alter()
+        except ParseError:
+            # e.g. CREATE INDEX
+            self.pos = start
+        return None
+
+def _cache_path(mapped):
+    # Cache entries are keyed by a hash of the file contents, so renamed or touched files still hit
+    digest = hashlib.blake2b(mapped, digest_size=20).hexdigest()
+    return os.path.join(_CACHE_DIR, f'{digest}-v{_CACHE_VERSION}.pkl')
+
+def _load_cached(cache_path):
+    try:
+        with open(cache_path, 'rb') as file:
+            results = pickle.load(file)
+    except Exception:
+        # A missing, unreadable or corrupt entry is just a cache miss
+        return None
+    try:
+        # Bump the modification time so _prune_cache evicts least recently used entries first
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return results
+
+def _store_cached(cache_path, results):
+    # Write to a temporary file and rename it, so concurrent workers never see a partial entry
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(results, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+def _prune_cache():
+    # Remove least recently used entries until the cache is back under _CACHE_MAX_BYTES
+    try:
+        with os.scandir(_CACHE_DIR) as entries:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries if entry.is_file()]
+    except OSError:
+        return
+    total_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_size <= _CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+def _parse_file(file_path):
+    # Parse one SQL file into an ordered list of (statement_type, table_name, columns_or_changes),
+    # where CREATE columns are parallel (names, types) lists and ALTER changes are (column_name, column_type) pairs
+    # Map the file instead of read()-ing it, so the contents are decoded straight from the page cache
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        # Skip files without any table DDL (data dumps, INSERT-only migrations). A hit may be inside a
+        # comment or string literal, so it only decides whether to parse the file, not where to start
+        if not _DDL_PREFILTER_RE.search(mapped):
+            return []
+        # Unchanged files are loaded from the on-disk cache instead of being parsed again
+        cache_path = _cache_path(mapped)
+        results = _load_cached(cache_path)
+        if results is not None:
+            return results
+        # Stream statements from the start of the file, decoding one at a time
+        # so memory use is bounded by the largest statement rather than the whole file
+        results = []
+        for match in _STATEMENT_RE.finditer(mapped):
+            statement = match.group()
+            if statement:
+                result = Parser(statement.decode('utf-8', 'replace')).parse_statement()
+                if result:
+                    results.append(result)
+
+    _store_cached(cache_path, results)
+    return results
+
+def _apply_create(schema, table_name, columns):
+    # Strings unpickled from the workers are fresh copies, so intern them again here
+    names, types = columns
+    schema[table_name] = ([_intern(name) for name in names], [_intern(type) for type in types])
+
+def _apply_alter(schema, table_name, changes):
+    if table_name in schema:
+        # Tables are small, so a linear scan over the names finds existing columns cheaply
+        names, types = schema[table_name]
+        for column_name, column_type in changes:
+            column_type = _intern(column_type)
+            try:
+                types[names.index(column_name)] = column_type
+            except ValueError:
+                names.append(_intern(column_name))
+                types.append(column_type)
+
+def _apply_noop(schema, table_name, columns):
+    pass
+
+# Number of "Processing file" lines buffered before they are written out
+_LOG_BATCH_SIZE = 64
+
+# Schema update for each statement type produced by _parse_file
+_HANDLERS = {
+    'CREATE': _apply_create,
+    'ALTER': _apply_alter,
+}
+
+def _migration_order(file_path):
+    # Sort key applying versioned migrations in numeric version order, so V1__ comes before V1.1__ and V2__
+    # before V10__; other files follow, by name
+    file_name = os.path.basename(file_path)
+    match = _FLYWAY_VERSION_RE.match(file_name)
+    if match:
+        return 0, tuple(int(part) for part in re.split('[._]', match.group(1))), file_name
+    return 1, (), file_name
+
+def process_schema(directory_path, quiet=False):
     schema = {}
+    log_buf = []
+    _prune_cache()
+
+    # List all files in the directory, in migration order so each ALTER is applied after its CREATE
+    with os.scandir(directory_path) as entries:
+        file_paths = sorted(
+            (
+                entry.path for entry in entries
+                # Empty files cannot be memory-mapped and contain no schema changes
+                if entry.name.endswith('.sql') and entry.is_file(follow_symlinks=False) and entry.stat().st_size
+            ),
+            key=_migration_order,
+        )
+
+    # Files are parsed independently in worker processes and merged here in order
+    get_handler = _HANDLERS.get
+    with ProcessPoolExecutor() as executor:
+        for file_path, results in zip(file_paths, executor.map(_parse_file, file_paths, chunksize=8)):
+            if not quiet:
+                # Progress lines are written in batches rather than one write per file
+                log_buf.append(f'Processing file: {file_path}\n')
+                if len(log_buf) >= _LOG_BATCH_SIZE:
+                    sys.stdout.write(''.join(log_buf))
+                    log_buf.clear()
+            for statement_type, table_name, columns in results:
+                get_handler(statement_type, _apply_noop)(schema, table_name, columns)
 
-    # List all files in the directory
-    for filename in os.listdir(directory_path):
-        if filename.endswith('.sql'):
-            file_path = os.path.join(directory_path, filename)
-            print(f'Processing file: {file_path}')
-
-            with open(file_path, 'r') as file:
-                sql_content = file.read()
-
-                # Parse SQL content
-                parsed_sql = sqlparse.parse(sql_content)
-
-                # Evaluate schema changes
-                for statement in parsed_sql:
-                    statement_type = statement.get_type()
-                    if statement_type == 'CREATE':
-                        # Extract table name and columns
-                        table_name = extract_table_name(statement)
-                        columns = extract_columns(statement)
-                        schema[table_name] = columns
-                    elif statement_type == 'ALTER':
-                        # Handle ALTER TABLE statements
-                        table_name, changes = extract_alterations(statement)
-                        if table_name in schema:
-                            schema[table_name].update(changes)
+    sys.stdout.write(''.join(log_buf))
 
     # Generate final schema in SQL format
     final_schema_sql = generate_final_schema_sql(schema)
-    print('Final Database Schema in SQL format:')
-    print(final_schema_sql)
-
-def extract_table_name(statement):
-    # Extract table name from CREATE TABLE statement
-    tokens = statement.tokens
-    for token in tokens:
-        if token.ttype is None and token.get_real_name():
-            return token.get_real_name()
-    return None
-
-def extract_columns(statement):
-    # Extract columns from CREATE TABLE statement
-    columns = {}
-    for token in statement.tokens:
-        if token.ttype is None and token.is_group:
-            for subtoken in token.tokens:
-                if subtoken.ttype is None and subtoken.is_group:
-                    column_name = subtoken.get_real_name()
-                    # Assuming the column type is the next token after the column name
-                    column_type = None
-                    for idx, subsubtoken in enumerate(subtoken.tokens):
-                        if subsubtoken.get_real_name() == column_name:
-                            # Get the next token as the column type
-                            if idx + 1 < len(subtoken.tokens):
-                                column_type = subtoken.tokens[idx + 1].value
-                    columns[column_name] = column_type
-    return columns
-
-def extract_alterations(statement):
-    # Extract table name and changes from ALTER TABLE statement
-    table_name = None
-    changes = {}
-    tokens = statement.tokens
-    for token in tokens:
-        if token.ttype is None and token.get_real_name():
-            table_name = token.get_real_name()
-        elif token.ttype is None and token.is_group:
-            for subtoken in token.tokens:
-                if subtoken.ttype is None and subtoken.is_group:
-                    column_name = subtoken.get_real_name()
-                    column_type = subtoken.get_type()
-                    changes[column_name] = column_type
-    return table_name, changes
+    # Write the encoded schema straight to the binary buffer, skipping the text layer
+    sys.stdout.flush()
+    sys.stdout.buffer.write(b'Final Database Schema in SQL format:\n')
+    sys.stdout.buffer.write(final_schema_sql.encode('utf-8'))
+    sys.stdout.buffer.write(b'\n')
+    sys.stdout.buffer.flush()
 
 def generate_final_schema_sql(schema):
-    # Generate SQL statements for the final schema
-    sql_statements = []
-    for table_name, columns in schema.items():
-        column_definitions = ', '.join([f'{name} {type}' for name, type in columns.items()])
-        sql_statements.append(f'CREATE TABLE {table_name} ({column_definitions});')
-    return '\n'.join(sql_statements)
+    # Generate SQL statements for the final schema in a single streaming join
+    return '\n'.join(
+        f"CREATE TABLE {table_name} ({', '.join(f'{name} {type}' for name, type in zip(names, types))});"
+        for table_name, (names, types) in schema.items()
+    )
 
 def main():
+    sys.stdout.reconfigure(write_through=True)
     parser = argparse.ArgumentParser(description='Process SQL files to evaluate the database schema.')
     parser.add_argument('directory', type=str, help='Path to the directory containing SQL files')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not list each processed file')
     args = parser.parse_args()
 
-    process_schema(args.directory)
+    process_schema(args.directory, quiet=args.quiet)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
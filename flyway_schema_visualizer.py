@@ -1,144 +1,206 @@
 import argparse
+import functools
+import hashlib
+import logging
+import os
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from natsort import natsorted, ns # ns for natural sort options
+from typing import Optional, TextIO
 import sqlglot
 from sqlglot import exp # To easily check expression types like exp.CreateTable
+from sqlglot.dialects import Dialect
+from sqlglot.tokens import TokenType
 import base64
-import io, requests
-from IPython.display import Image, display
-from PIL import Image as im
-import matplotlib.pyplot as plt
+import io
 
 # --- Configuration ---
+logger = logging.getLogger(__name__)
+
 # Attempt to guess dialect, but can be overridden via command line
 DEFAULT_SQL_DIALECT = 'postgres' # Common dialects: 'mysql', 'postgres', 'sqlite', 'tsql' (SQL Server)
 
+# --- Precompiled patterns ---
+# Foreign key regex breakdown:
+# FOREIGN KEY\s*\((.*?)\)       # Capture column(s) inside parentheses after FOREIGN KEY
+# \s*REFERENCES\s*              # Match REFERENCES keyword
+# (\w+)                         # Capture the referenced table name (simple word)
+# (?:\s*\(.*?\))?                # Optionally match referenced columns (non-capturing)
+# (?:\s+ON\s+(?:DELETE|UPDATE).*)* # Optionally match ON DELETE/UPDATE clauses (non-capturing)
+_FK_RE = re.compile(
+    r"FOREIGN KEY\s*\((.*?)\)\s*REFERENCES\s*(\w+)(?:\s*\(.*?\))?(?:\s+ON\s+(?:DELETE|UPDATE).*)*",
+    re.IGNORECASE
+)
+# Versioned Flyway migration file name, e.g. V1.2.3__Desc.sql or V1_2__Desc.sql
+_FLYWAY_RE = re.compile(r"^[Vv]([0-9]+(?:[._][0-9]+)*)_.*\.sql$")
+# Deletes identifier quotes in a single str.translate call
+_QUOTE_TRANS = str.maketrans('', '', '`"')
+# Below this many scripts, parsing runs in-process instead of in a worker pool
+_PARALLEL_MIN_FILES = 16
+# Diagrams rendered by mermaid.ink, keyed by a hash of their Mermaid source
+_MERMAID_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'flyway-viz'
+
+class _LazyStr:
+    """Defers an expensive message argument (e.g. re-serializing SQL) until a log record actually gets formatted."""
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
 # --- Helper function for Mermaid ---
 
+@functools.lru_cache(maxsize=None)
+def _http_session():
+    """Returns a shared requests session, so repeated renders reuse the connection to mermaid.ink."""
+    import requests # Only needed for rendering, so it is not imported at startup or by parser workers
+    return requests.Session()
+
 def plot_mermaid_visual(graph):
+    # Imported here so the CLI and the parser worker processes don't pay for loading the plotting stack
+    from PIL import Image as im
+    import matplotlib.pyplot as plt
+
     graphbytes = graph.encode("utf8")
-    base64_bytes = base64.urlsafe_b64encode(graphbytes)
-    base64_string = base64_bytes.decode("ascii")
-    img = im.open(io.BytesIO(requests.get('https://mermaid.ink/img/' + base64_string).content))
+    # Unchanged diagrams are served from the cache instead of being rendered by mermaid.ink again
+    cache_path = _MERMAID_CACHE_DIR / f"{hashlib.sha256(graphbytes).hexdigest()}.img"
+    try:
+        image_bytes = cache_path.read_bytes()
+    except OSError:
+        base64_bytes = base64.urlsafe_b64encode(graphbytes)
+        base64_string = base64_bytes.decode("ascii")
+        response = _http_session().get('https://mermaid.ink/img/' + base64_string)
+        response.raise_for_status() # Never cache an error page
+        image_bytes = response.content
+        try:
+            _MERMAID_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so a concurrent run never reads a partial image
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(image_bytes)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass # The cache is only an optimization
+    img = im.open(io.BytesIO(image_bytes))
     plt.imshow(img)
     plt.axis('off') # allow to hide axis
     plt.savefig('image.png', dpi=1200)
 
+@functools.lru_cache(maxsize=4096)
 def parse_foreign_key(constraint_sql):
     """
     Parses a FOREIGN KEY constraint string to extract relevant info for Mermaid.
-    Returns a tuple: (child_columns_list, referenced_table) or None if parsing fails.
-    Example: FOREIGN KEY (author_id) REFERENCES users(id) -> (['author_id'], 'users')
-             FOREIGN KEY (col_a, col_b) REFERENCES other_table -> (['col_a', 'col_b'], 'other_table')
+    Returns a tuple: (child_columns_tuple, referenced_table) or None if parsing fails.
+    Example: FOREIGN KEY (author_id) REFERENCES users(id) -> (('author_id',), 'users')
+             FOREIGN KEY (col_a, col_b) REFERENCES other_table -> (('col_a', 'col_b'), 'other_table')
+    Results are memoized, since the same constraints are parsed again on every format_schema_mermaid call;
+    the child columns are a tuple so the shared result cannot be modified.
     NOTE: This is a simplified parser, assumes standard syntax.
     """
-    # Regex breakdown:
-    # FOREIGN KEY\s*\((.*?)\)       # Capture column(s) inside parentheses after FOREIGN KEY
-    # \s*REFERENCES\s*              # Match REFERENCES keyword
-    # (\w+)                         # Capture the referenced table name (simple word)
-    # (?:\s*\(.*?\))?                # Optionally match referenced columns (non-capturing)
-    # (?:\s+ON\s+(?:DELETE|UPDATE).*)* # Optionally match ON DELETE/UPDATE clauses (non-capturing)
-    match = re.search(
-        r"FOREIGN KEY\s*\((.*?)\)\s*REFERENCES\s*(\w+)(?:\s*\(.*?\))?(?:\s+ON\s+(?:DELETE|UPDATE).*)*",
-        constraint_sql,
-        re.IGNORECASE
-    )
+    # See _FK_RE for the regex breakdown
+    match = _FK_RE.search(constraint_sql)
     if match:
         child_cols_str = match.group(1)
         referenced_table = match.group(2)
         # Split columns, remove potential quotes and whitespace
-        child_columns = [col.strip().strip('`"') for col in child_cols_str.split(',')]
-        return child_columns, referenced_table.strip('`"')
+        child_columns = tuple(col.translate(_QUOTE_TRANS).strip() for col in child_cols_str.split(','))
+        return child_columns, referenced_table # \w+ in _FK_RE never matches quotes
     return None
 
 # --- Function to generate Mermaid code ---
 
-def format_schema_mermaid(schema_dict):
-    """Generates Mermaid ER diagram code from the schema dictionary."""
-    output = ["erDiagram"]
-    relationships = []
-    foreign_key_columns = {} # Store FK columns for marking: {'table': {'col1', 'col2'}}
+def _mermaid_column_line(col_name, col_info, is_fk):
+    """Builds the Mermaid entity line for a single column, including its PK/FK/UK/NN markers."""
+    col_type = col_info.get('type', 'UNKNOWN').replace(" ", "_") # Replace spaces in type for Mermaid ID safety
+    # Upper-case the constraints once; the separator keeps keywords from matching across two constraints
+    upper_constraints = " | ".join(c.upper() for c in col_info.get('constraints', []))
+    markers = [
+        marker for marker, present in (
+            ("PK", "PRIMARY KEY" in upper_constraints),
+            ("FK", is_fk),
+            ("UK", "UNIQUE" in upper_constraints),
+            ("NN", "NOT NULL" in upper_constraints),
+        ) if present
+    ]
+    marker_str = f" \"{','.join(markers)}\"" if markers else ""
+    # Escape quotes in column names/types if necessary, though unlikely needed for standard names
+    return f"        {col_type} {col_name}{marker_str}"
+
+def format_schema_mermaid(schema_dict, out: Optional[TextIO] = None):
+    """
+    Generates Mermaid ER diagram code from the schema dictionary.
+    Writes it to out if given, otherwise returns it as a string.
+    Warnings are printed to stderr once rendering is done, so they never end up inside the diagram.
+    """
+    buffer = io.StringIO() if out is None else out
+    write = buffer.write
+    write("erDiagram")
+    # Keyed by the fields of the relationship line, in the same order as in the line, so duplicates collapse
+    # and sorting the keys orders the lines exactly like sorting the formatted strings would
+    relationships = {}
+    skipped_relationship_warnings = []
+
+    # --- Single pass: Generate Table Definitions and Collect Relationships ---
+    sorted_table_names = sorted(schema_dict.get('tables', {}).keys())
 
-    # --- Pass 1: Identify all Foreign Key columns ---
-    for table_name, table_info in schema_dict.get('tables', {}).items():
-        if table_name not in foreign_key_columns:
-            foreign_key_columns[table_name] = set()
+    for table_name in sorted_table_names:
+        table_info = schema_dict['tables'][table_name]
 
+        # A table's FK columns only depend on its own constraints, so identify them right before emitting it
+        foreign_keys = [] # (constraint, (child_columns, referenced_table))
         for constraint in table_info.get('constraints', []):
             parsed_fk = parse_foreign_key(constraint)
             if parsed_fk:
-                child_columns, _ = parsed_fk
-                for col in child_columns:
-                     foreign_key_columns[table_name].add(col) # Mark column as FK
-
-    # --- Pass 2: Generate Table Definitions and Collect Relationships ---
-    sorted_table_names = sorted(schema_dict.get('tables', {}).keys())
+                foreign_keys.append((constraint, parsed_fk))
+        foreign_key_columns = {col for _, (child_columns, _) in foreign_keys for col in child_columns}
 
-    for table_name in sorted_table_names:
-        table_info = schema_dict['tables'][table_name]
-        output.append(f"    {table_name} {{")
+        write(f"\n    {table_name} {{")
 
         if not table_info.get('columns'):
-            output.append("        # (No columns defined)") # Mermaid comment
+            write("\n        # (No columns defined)") # Mermaid comment
         else:
-            sorted_col_names = sorted(table_info['columns'].keys())
-            for col_name in sorted_col_names:
-                col_info = table_info['columns'][col_name]
-                col_type = col_info.get('type', 'UNKNOWN').replace(" ", "_") # Replace spaces in type for Mermaid ID safety
-                col_constraints = col_info.get('constraints', [])
-
-                markers = []
-                is_pk = any("PRIMARY KEY" in c.upper() for c in col_constraints)
-                is_nn = any("NOT NULL" in c.upper() for c in col_constraints)
-                is_uk = any("UNIQUE" in c.upper() for c in col_constraints)
-                # Check if this column was marked as an FK in Pass 1
-                is_fk = col_name in foreign_key_columns.get(table_name, set())
-
-                if is_pk: markers.append("PK")
-                if is_fk: markers.append("FK")
-                if is_uk: markers.append("UK")
-                if is_nn: markers.append("NN")
-
-                marker_str = f" \"{','.join(markers)}\"" if markers else ""
-                # Escape quotes in column names/types if necessary, though unlikely needed for standard names
-                output.append(f"        {col_type} {col_name}{marker_str}")
-
-        output.append("    }")
-        output.append("") # Blank line for readability
-
-        # Process constraints for relationships
-        for constraint in table_info.get('constraints', []):
-             parsed_fk = parse_foreign_key(constraint)
-             if parsed_fk:
-                 child_columns, referenced_table = parsed_fk
-                 if referenced_table in schema_dict.get('tables', {}): # Ensure referenced table exists
-                     # Determine cardinality (simplified: check nullability of the first FK column)
-                     first_child_col = child_columns[0]
-                     child_col_info = table_info.get('columns', {}).get(first_child_col)
-                     child_col_constraints = child_col_info.get('constraints', []) if child_col_info else []
-                     is_child_nn = any("NOT NULL" in c.upper() for c in child_col_constraints)
-
-                     # ||--|{ : one to one-or-more (FK is NOT NULL)
-                     # ||--o{ : one to zero-or-more (FK is NULLABLE)
-                     # Other cardinality like zero-or-one requires more info (e.g., UNIQUE constraint on FK)
-                     # Defaulting to one-to-many type relationships
-                     cardinality = "||--|{" if is_child_nn else "||--o{"
-
-                     # Use first child column name in label for clarity (optional)
-                     label = f"\"FK: {first_child_col}\"" # Use quotes for labels with spaces/special chars
-                     relationships.append(f"    {referenced_table} {cardinality} {table_name} : {label}")
-                 else:
-                      print(f"Warning: Skipping relationship for constraint '{constraint}' because referenced table '{referenced_table}' was not found in the final schema.")
+            buffer.writelines(
+                "\n" + _mermaid_column_line(col_name, col_info, col_name in foreign_key_columns)
+                for col_name, col_info in sorted(table_info['columns'].items())
+            )
+
+        write("\n    }\n") # Blank line for readability
+
+        # Process foreign keys for relationships
+        for constraint, (child_columns, referenced_table) in foreign_keys:
+             if referenced_table in schema_dict.get('tables', {}): # Ensure referenced table exists
+                 # Determine cardinality (simplified: check nullability of the first FK column)
+                 first_child_col = child_columns[0]
+                 child_col_info = table_info.get('columns', {}).get(first_child_col)
+                 child_col_constraints = child_col_info.get('constraints', []) if child_col_info else []
+                 is_child_nn = "NOT NULL" in " | ".join(c.upper() for c in child_col_constraints)
+
+                 # ||--|{ : one to one-or-more (FK is NOT NULL)
+                 # ||--o{ : one to zero-or-more (FK is NULLABLE)
+                 # Other cardinality like zero-or-one requires more info (e.g., UNIQUE constraint on FK)
+                 # Defaulting to one-to-many type relationships
+                 cardinality = "||--|{" if is_child_nn else "||--o{"
+
+                 # Use first child column name in label for clarity (optional)
+                 label = f"\"FK: {first_child_col}\"" # Use quotes for labels with spaces/special chars
+                 relationships[(referenced_table, cardinality, table_name, first_child_col)] = f"    {referenced_table} {cardinality} {table_name} : {label}"
+             else:
+                  skipped_relationship_warnings.append(f"Warning: Skipping relationship for constraint '{constraint}' because referenced table '{referenced_table}' was not found in the final schema.")
 
 
     # Append relationships at the end
     if relationships:
-        output.append("    %% -- Relationships --") # Mermaid comment
-        # Add unique relationships only to avoid duplicates if defined multiple ways
-        output.extend(sorted(list(set(relationships))))
+        write("\n    %% -- Relationships --") # Mermaid comment
+        # Relationships defined multiple ways were already deduplicated by their key
+        buffer.writelines("\n" + relationship for _, relationship in sorted(relationships.items()))
+
+    for warning in skipped_relationship_warnings:
+        print(warning, file=sys.stderr)
 
-    return "\n".join(output)
+    return buffer.getvalue() if out is None else None
 
 # --- Helper Functions for Flyway --- 
 
@@ -151,7 +213,7 @@ def parse_flyway_version(filename):
              U1.2__Desc.sql -> None (Undo scripts shouldn't contribute to final state)
     Returns None if it's not a versioned migration ('V' prefix).
     """
-    match = re.match(r"^[Vv]([0-9]+(?:[._][0-9]+)*)_.*\.sql$", filename.name)
+    match = _FLYWAY_RE.match(filename.name)
     if match:
         version_str = match.group(1).replace('_', '.')
         try:
@@ -164,96 +226,150 @@ def parse_flyway_version(filename):
 
 def extract_column_def(col_def_exp):
     """Extracts name, type, and constraints from a sqlglot ColumnDef expression."""
-    col_name = col_def_exp.find(exp.Identifier).name
-    col_type = col_def_exp.find(exp.DataType).sql(dialect=current_dialect) # Use global dialect
-    constraints = []
-    for constraint in col_def_exp.find_all(exp.ColumnConstraint):
-        constraints.append(constraint.sql(dialect=current_dialect).upper())
+    # Read the ColumnDef's own args instead of searching its whole subtree
+    col_name = col_def_exp.name
+    col_type = col_def_exp.args.get('kind').sql(dialect=current_dialect_obj) # Use global dialect
+    constraints = [constraint.sql(dialect=current_dialect_obj).upper() for constraint in col_def_exp.args.get('constraints') or []]
     return col_name, {'type': col_type, 'constraints': constraints}
 
-def format_schema_output(schema_dict):
-    """Generates a readable string representation of the schema."""
-    output = []
-    output.append("--- Generated Final Schema ---")
+def _output_column_line(col_name, col_info):
+    """Builds the text output line for a single column, including its constraints."""
+    constraints_str = f" ({', '.join(col_info['constraints'])})" if col_info['constraints'] else ""
+    return f"\n    - {col_name}: {col_info['type']}{constraints_str}"
+
+def _output_index_line(idx_name, idx_info):
+    """Builds the text output line for a single index."""
+    unique_str = "UNIQUE " if idx_info['unique'] else ""
+    cols_str = ', '.join(idx_info['columns'])
+    return f"\n    - {idx_name}: {unique_str}INDEX ({cols_str})"
+
+def format_schema_output(schema_dict, out: Optional[TextIO] = None):
+    """
+    Generates a readable string representation of the schema.
+    Writes it to out if given, otherwise returns it as a string.
+    """
+    buffer = io.StringIO() if out is None else out
+    write = buffer.write
+    write("--- Generated Final Schema ---")
 
     if not schema_dict.get('tables'):
-        output.append("\nNo tables found in the final schema.")
-        return "\n".join(output)
+        write("\n\nNo tables found in the final schema.")
+        return buffer.getvalue() if out is None else None
 
     # Sort tables by name for consistent output
     sorted_table_names = sorted(schema_dict['tables'].keys())
 
     for table_name in sorted_table_names:
         table_info = schema_dict['tables'][table_name]
-        output.append(f"\n-- Table: {table_name}")
+        write(f"\n\n-- Table: {table_name}")
 
         if not table_info.get('columns'):
-            output.append("  (No columns defined)")
+            write("\n  (No columns defined)")
         else:
-            output.append("  Columns:")
+            write("\n  Columns:")
             # Sort columns for consistent output
-            sorted_col_names = sorted(table_info['columns'].keys())
-            for col_name in sorted_col_names:
-                col_info = table_info['columns'][col_name]
-                constraints_str = f" ({', '.join(col_info['constraints'])})" if col_info['constraints'] else ""
-                output.append(f"    - {col_name}: {col_info['type']}{constraints_str}")
+            buffer.writelines(
+                _output_column_line(col_name, col_info) for col_name, col_info in sorted(table_info['columns'].items())
+            )
 
         if table_info.get('indexes'):
-             output.append("  Indexes:")
+             write("\n  Indexes:")
              # Sort indexes for consistent output
-             sorted_idx_names = sorted(table_info['indexes'].keys())
-             for idx_name in sorted_idx_names:
-                 idx_info = table_info['indexes'][idx_name]
-                 unique_str = "UNIQUE " if idx_info['unique'] else ""
-                 cols_str = ', '.join(idx_info['columns'])
-                 output.append(f"    - {idx_name}: {unique_str}INDEX ({cols_str})")
+             buffer.writelines(
+                 _output_index_line(idx_name, idx_info) for idx_name, idx_info in sorted(table_info['indexes'].items())
+             )
 
         if table_info.get('constraints'):
-            output.append("  Table Constraints:")
+            write("\n  Table Constraints:")
             # Sort constraints for consistent output
-            sorted_constraints = sorted(table_info['constraints'])
-            for constr in sorted_constraints:
-                 output.append(f"    - {constr}")
+            buffer.writelines(f"\n    - {constr}" for constr in sorted(table_info['constraints']))
 
 
     if schema_dict.get('not_processed'):
         unprocessed_sqls = sorted(schema_dict['not_processed'].keys())
 
-    for sql in unprocessed_sqls:
-        sql_info = schema_dict['not_processed'][sql]
-        output.append(f"\n-- Not processed: {sql_info}")
+    buffer.writelines(f"\n\n-- Not processed: {schema_dict['not_processed'][sql]}" for sql in unprocessed_sqls)
 
-    output.append("\n--- End of Schema ---")
-    return "\n".join(output)
+    write("\n\n--- End of Schema ---")
+    return buffer.getvalue() if out is None else None
 
 # --- Main Processing Logic ---
 
-# Global variable to hold the current dialect being used for parsing/formatting
-current_dialect = DEFAULT_SQL_DIALECT
+# Global variable to hold the current dialect being used for parsing/formatting. It is a resolved
+# Dialect instance, so sqlglot doesn't look the dialect up by name on every .sql() call
+current_dialect_obj = Dialect.get_or_raise(DEFAULT_SQL_DIALECT)
+
+def parse_statements(sql_content, dialect):
+    """
+    Parses a script one statement at a time, splitting the token stream on ';' so
+    semicolons inside strings, quoted identifiers and comments are respected.
+    """
+    try:
+        parser = dialect.parser()
+        expressions = []
+        statement_tokens = []
+        # Tokens keep their comments and offsets into sql_content, so each statement is parsed exactly as in a whole-file parse
+        for token in dialect.tokenize(sql_content):
+            if token.token_type != TokenType.SEMICOLON:
+                statement_tokens.append(token)
+            elif statement_tokens: # Skip empty statements like ';;'
+                expressions.extend(parser.parse(statement_tokens, sql_content))
+                statement_tokens = []
+        if statement_tokens:
+            expressions.extend(parser.parse(statement_tokens, sql_content))
+        return expressions
+    except sqlglot.errors.SqlglotError:
+        # Fall back to parsing the whole script, so failures are reported the same way as before
+        return sqlglot.parse(sql_content, read=dialect)
+
+def find_sql_files(directory):
+    """Recursively yields the paths of all .sql files under directory, like rglob('*.sql') but without the pathlib overhead."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from find_sql_files(entry.path)
+            elif entry.name.endswith('.sql') and entry.is_file():
+                yield entry.path
+
+def parse_sql_file(filepath: Path, dialect: str):
+    """
+    Reads and parses one script in a worker process. Errors are returned instead of
+    raised, so the caller can report them when it reaches the file in version order.
+    """
+    try:
+        with open(filepath, 'rb') as sql_file:
+            # Normalize line endings like read_text's universal newlines, so CRLF scripts don't leak '\r' into the SQL
+            sql_content = sql_file.read().decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        return parse_statements(sql_content, Dialect.get_or_raise(dialect)), None
+    except Exception as e:
+        return None, e
 
 def process_sql_scripts(directory: Path, dialect: str):
     """
     Finds, sorts, parses Flyway scripts, and simulates schema changes.
     """
-    global current_dialect # Allow modification of the global dialect
-    current_dialect = dialect
+    global current_dialect_obj # Allow modification of the global dialect
+    current_dialect_obj = Dialect.get_or_raise(dialect)
 
     schema = {'tables': {}, 'not_processed': {}} # Structure: {'table_name': {'columns': {}, 'indexes': {}, 'constraints': []}}
+    # Maps index_name -> table_name of the last CREATE INDEX using that name, so DROP INDEX without an ON clause
+    # doesn't have to search every table. Internal bookkeeping only, so it is kept out of the returned schema.
+    index_owner = {}
     sql_files = []
 
     # 1. Find all .sql files and extract versions
     print(f"Scanning directory: {directory}")
-    for item in directory.rglob('*.sql'): # Use rglob for recursive search
-        if item.is_file():
-            version = parse_flyway_version(item)
-            if version:
-                sql_files.append({'path': item, 'version': version})
-            else:
-                print(f"Info: Skipping non-versioned file: {item.name}")
-
-    # 2. Sort files by version using natural sort order
-    # Use natsorted which handles tuples like (1, 1) vs (1, 10) correctly
-    sorted_files = natsorted(sql_files, key=lambda x: x['version'], alg=ns.REAL)
+    for item_path in find_sql_files(directory): # Recursive search
+        item = Path(item_path) # parse_flyway_version and the log messages work on Path objects
+        version = parse_flyway_version(item)
+        if version:
+            sql_files.append({'path': item, 'version': version})
+        else:
+            print(f"Info: Skipping non-versioned file: {item.name}")
+
+    # 2. Sort files by version
+    # Versions are tuples of ints, so plain tuple comparison already orders (1, 1) before (1, 10)
+    sorted_files = sorted(sql_files, key=lambda x: x['version'])
 
     if not sorted_files:
         print("No valid Flyway versioned SQL files found.")
@@ -261,14 +377,25 @@ def process_sql_scripts(directory: Path, dialect: str):
 
     print(f"\nFound {len(sorted_files)} versioned SQL files. Processing in order:")
 
-    # 3. Process sorted files
+    # 3. Parse the files in parallel; only applying them to the schema has to happen in version order
+    file_paths = [file_info['path'] for file_info in sorted_files]
+    if len(file_paths) < _PARALLEL_MIN_FILES:
+        # Starting worker processes costs more than parsing a handful of scripts
+        parse_results = {path: parse_sql_file(path, dialect) for path in file_paths}
+    else:
+        chunksize = max(1, len(file_paths) // (4 * (os.cpu_count() or 1)))
+        with ProcessPoolExecutor() as executor:
+            parse_results = dict(zip(file_paths, executor.map(parse_sql_file, file_paths, repeat(dialect), chunksize=chunksize)))
+
+    # 4. Process sorted files
     for file_info in sorted_files:
         filepath = file_info['path']
         print(f"  -> Processing: {filepath.name}")
         try:
-            sql_content = filepath.read_text(encoding='utf-8')
-            # Parse the whole file. Handle potential multiple statements per file.
-            parsed_expressions = sqlglot.parse(sql_content, read=dialect)
+            # Each statement was parsed separately. Handle potential multiple statements per file.
+            parsed_expressions, error = parse_results[filepath]
+            if error is not None:
+                raise error
 
             for expression in parsed_expressions:
                 # Use 'try...except' for robustness against complex/unsupported SQL
@@ -280,7 +407,7 @@ def process_sql_scripts(directory: Path, dialect: str):
                             print(f"      Warning: Table '{table_name}' already exists. Re-creating (check scripts).")
                             # Overwrite definition based on Flyway logic (last script wins)
 
-                        schema['tables'][table_name] = {'columns': {}, 'indexes': {}, 'constraints': []}
+                        tbl = schema['tables'][table_name] = {'columns': {}, 'indexes': {}, 'constraints': []}
                         
                         # Extract columns
                         schema_exp = expression.this # The Schema object within CreateTable
@@ -288,10 +415,10 @@ def process_sql_scripts(directory: Path, dialect: str):
                              for elem in schema_exp.expressions:
                                 if isinstance(elem, exp.ColumnDef):
                                     col_name, col_info = extract_column_def(elem)
-                                    schema['tables'][table_name]['columns'][col_name] = col_info
+                                    tbl['columns'][col_name] = col_info
                                 elif isinstance(elem, exp.ForeignKey):
                                      # Store raw constraint SQL for simplicity
-                                     schema['tables'][table_name]['constraints'].append(elem.sql(dialect=dialect))
+                                     tbl['constraints'].append(elem.sql(dialect=current_dialect_obj))
                                 elif isinstance(elem, exp.Index): # Sometimes indexes are part of CREATE TABLE
                                      # Handle inline index definitions if needed (less common)
                                      pass # Add logic here if necessary
@@ -313,7 +440,8 @@ def process_sql_scripts(directory: Path, dialect: str):
                     # --- ALTER TABLE ---
                     elif (expression.key == "alter" and expression.kind == "TABLE"):
                         table_name = expression.this.find(exp.Table).name
-                        if table_name not in schema['tables']:
+                        tbl = schema['tables'].get(table_name)
+                        if tbl is None:
                             print(f"      Warning: Altering non-existent table: {table_name}. Skipping action.")
                             continue
 
@@ -324,16 +452,16 @@ def process_sql_scripts(directory: Path, dialect: str):
                                 # col_def = action.this
                                 col_def = action
                                 col_name, col_info = extract_column_def(col_def)
-                                if col_name in schema['tables'][table_name]['columns']:
+                                if col_name in tbl['columns']:
                                     print(f"      Warning: Column '{col_name}' already exists in table '{table_name}'. Overwriting definition.")
                                 print(f"      Adding column: {table_name}.{col_name}")
-                                schema['tables'][table_name]['columns'][col_name] = col_info
+                                tbl['columns'][col_name] = col_info
                             # DROP COLUMN
                             elif (action.key == "drop" and action.kind == "COLUMN"):
                                 col_name = action.this.find(exp.Identifier).name
-                                if col_name in schema['tables'][table_name]['columns']:
+                                if col_name in tbl['columns']:
                                     print(f"      Dropping column: {table_name}.{col_name}")
-                                    del schema['tables'][table_name]['columns'][col_name]
+                                    del tbl['columns'][col_name]
                                 else:
                                      print(f"      Warning: Dropping non-existent column: {table_name}.{col_name}")
                             # ALTER COLUMN / MODIFY COLUMN (Syntax varies)
@@ -343,7 +471,7 @@ def process_sql_scripts(directory: Path, dialect: str):
                                 identifier = action.this.find(exp.Identifier)
                                 col_name = identifier.name
                                 new_name = identifier.output_name
-                                if col_name in schema['tables'][table_name]['columns']:
+                                if col_name in tbl['columns']:
                                     print(f"      Altering column: {table_name}.{col_name} (Details depend on specific ALTER action)")
                                     # Basic approach: Just log it. More complex: parse the action type (e.g., SET TYPE)
                                     # For simplicity, we won't parse the *exact* change here, but acknowledge it happened.
@@ -357,8 +485,8 @@ def process_sql_scripts(directory: Path, dialect: str):
                                         try:
                                             new_col_name, new_col_info = extract_column_def(action.this)
                                             if new_col_name == col_name:
-                                                print(f"        -> Applying new definition (Type/Constraints): {action.this.sql(dialect=current_dialect)}")
-                                                schema['tables'][table_name]['columns'][col_name] = new_col_info
+                                                print(f"        -> Applying new definition (Type/Constraints): {action.this.sql(dialect=current_dialect_obj)}")
+                                                tbl['columns'][col_name] = new_col_info
                                                 updated = True
                                             else:
                                                 # This case would be RENAME, which needs separate handling
@@ -373,10 +501,10 @@ def process_sql_scripts(directory: Path, dialect: str):
                                         # Check for data type change
                                         new_type_exp = action.this.find(exp.DataType)
                                         if new_type_exp:
-                                            new_type_sql = new_type_exp.sql(dialect=current_dialect)
+                                            new_type_sql = new_type_exp.sql(dialect=current_dialect_obj)
                                             print(f"        -> Updating type to: {new_type_sql}")
                                             # TODO: check this
-                                            schema['tables'][table_name]['columns'][col_name] = new_type_sql
+                                            tbl['columns'][col_name] = new_type_sql
                                             updated = True
                                         
                                         # Check for constraint changes *within* the alter action
@@ -385,26 +513,26 @@ def process_sql_scripts(directory: Path, dialect: str):
                                         if action_constraints:
                                             # Simple approach: Assume these REPLACE existing type-specific constraints (NULL/NOT NULL, DEFAULT)
                                             # More robust: Parse 'kind' (SET/DROP) and merge carefully
-                                            print(f"        -> Found constraints within ALTER action: {[c.sql(dialect=current_dialect) for c in action_constraints]}")
+                                            logger.debug("        -> Found constraints within ALTER action: %s", _LazyStr(lambda: [c.sql(dialect=current_dialect_obj) for c in action_constraints]))
                                             # Naive update: Replace constraints entirely with these new ones + any non-overridden old ones.
                                             # This is likely INACCURATE for many cases (e.g., doesn't handle DROP). Needs refinement.
                                             # For now, just log that we found them. A better implementation is needed for precise constraint updates via SET/DROP.
-                                            # table_schema['columns'][col_name]['constraints'] = [c.sql(dialect=current_dialect) for c in action_constraints]
+                                            # table_schema['columns'][col_name]['constraints'] = [c.sql(dialect=current_dialect_obj) for c in action_constraints]
                                             print(f"        -> (Info) Constraint update logic based on SET/DROP kind is basic. Review final schema.")
                                             updated = True # Mark as updated even if logic is simple
                                         
                                     # Fallback Log
                                     if not updated:
-                                        print(f"        -> Alteration type not fully parsed/applied by this script: {action.sql(dialect=current_dialect)}")
+                                        print(f"        -> Alteration type not fully parsed/applied by this script: {action.sql(dialect=current_dialect_obj)}")
 
                                 else:
                                     print(f"      Warning: Altering non-existent column: {table_name}.{col_name}")
                             # ADD CONSTRAINT
                             elif isinstance(action, exp.AddConstraint):
-                                 #constraint_sql = action.this.sql(dialect=dialect)
-                                 constraint_sql = action.sql(dialect=dialect)
+                                 #constraint_sql = action.this.sql(dialect=current_dialect_obj)
+                                 constraint_sql = action.sql(dialect=current_dialect_obj)
                                  print(f"      Adding constraint to {table_name}: {constraint_sql}")
-                                 schema['tables'][table_name]['constraints'].append(constraint_sql)
+                                 tbl['constraints'].append(constraint_sql)
                             # DROP CONSTRAINT (Parsing might be tricky)
                             # RENAME TABLE / COLUMN etc (Add more handlers as needed)
                             else:
@@ -414,38 +542,47 @@ def process_sql_scripts(directory: Path, dialect: str):
                     elif (expression.key == "create" and expression.kind == "INDEX"):
                         index_name = expression.this.find(exp.Identifier).name
                         table_name = expression.find(exp.Table).name
-                        if table_name in schema['tables']:
+                        tbl = schema['tables'].get(table_name)
+                        if tbl is not None:
                             cols = [col.name for col in expression.find(exp.Index).find_all(exp.Identifier)]
-                            is_unique = expression.find(exp.UniqueColumnConstraint) is not None or 'unique' in expression.sql(dialect=dialect).lower() # Simple check
+                            is_unique = bool(expression.args.get('unique')) # Set by the parser for CREATE UNIQUE INDEX
                             print(f"      Creating {'UNIQUE ' if is_unique else ''}index '{index_name}' on {table_name} ({', '.join(cols)})")
-                            schema['tables'][table_name]['indexes'][index_name] = {'columns': cols, 'unique': is_unique}
+                            tbl['indexes'][index_name] = {'columns': cols, 'unique': is_unique}
+                            index_owner[index_name] = table_name
                         else:
                             print(f"      Warning: Creating index on non-existent table: {table_name}")
 
                     # --- DROP INDEX ---
                     elif (expression.key == "drop" and expression.kind == "INDEX"):
-                         index_name = expression.this.find(exp.Identifier).name
-                         # Finding the table might require context or specific dialect parsing
-                         # Assume we can find it associated with a table in our schema
-                         found = False
-                         for table_name, table_info in schema['tables'].items():
-                            if index_name in table_info['indexes']:
-                                print(f"      Dropping index: {index_name} from table {table_name}")
-                                del table_info['indexes'][index_name]
-                                found = True
-                                break
-                         if not found:
+                         # sqlglot parses the dropped index like a table name, ahead of any ON clause
+                         index_name = expression.find(exp.Table).name
+                         on_property = expression.find(exp.OnProperty)
+                         if on_property:
+                             # MySQL / SQL Server name the table ("DROP INDEX idx ON tbl"); index names are only unique per table there
+                             table_name = on_property.find(exp.Table).name
+                         else:
+                             # Otherwise assume the index belongs to the table that last created it
+                             table_name = index_owner.get(index_name)
+                         # The owner may be stale if its table was dropped or re-created since the index was created
+                         table_info = schema['tables'].get(table_name)
+                         if table_info and index_name in table_info['indexes']:
+                             print(f"      Dropping index: {index_name} from table {table_name}")
+                             del table_info['indexes'][index_name]
+                             if index_owner.get(index_name) == table_name:
+                                 del index_owner[index_name]
+                         else:
                              print(f"      Warning: Could not find index '{index_name}' to drop.")
 
                     # TODO: Add handlers for other DDL like CREATE VIEW, ALTER VIEW, etc. if needed
                     
                     # Fallback, just log
                     elif (expression.key == 'command'):
-                        schema['not_processed'][filepath.name] = expression.sql(dialect=dialect)
+                        schema['not_processed'][filepath.name] = expression.sql(dialect=current_dialect_obj)
 
                 except Exception as parse_err:
                     print(f"      ERROR processing statement in {filepath.name}: {parse_err}")
-                    print(f"      Statement causing error: {expression.sql(dialect=dialect)}")
+                    # Only pay for re-serializing the statement when debug logging is enabled
+                    logger.debug("      Statement causing error: %s", _LazyStr(lambda: expression.sql(dialect=current_dialect_obj)))
                     # Decide whether to continue or stop on error
 
         except sqlglot.errors.ParseError as e:
@@ -465,6 +602,11 @@ def process_sql_scripts(directory: Path, dialect: str):
 
 # --- Main Execution ---
 
+@functools.lru_cache(maxsize=None)
+def _all_dialects():
+    """Returns the names of all dialects sqlglot supports, computed once."""
+    return tuple(member.value for member in sqlglot.dialects.Dialects if member.value)
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate a final DB schema representation from Flyway SQL scripts.",
@@ -475,13 +617,11 @@ def main():
         type=str,
         help="Directory containing the Flyway SQL migration files."
         )
-    all_dialacts = [member.value for member in sqlglot.dialects.Dialects if member.value]
-    print(all_dialacts)
     parser.add_argument(
         "-d", "--dialect",
         type=str,
         default=DEFAULT_SQL_DIALECT,
-        help=f"SQL dialect for parsing (e.g., {', '.join(all_dialacts)})."
+        help=f"SQL dialect for parsing (e.g., {', '.join(_all_dialects())})."
         )
     parser.add_argument(
         "-o", "--output",
@@ -496,16 +636,24 @@ def main():
         help="Output format for the schema."
     )
 
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Also log debug details, such as the SQL of statements that failed to process."
+    )
+
     args = parser.parse_args()
+    # Log to stdout, so debug details stay next to the printed ERROR lines they belong to when output is redirected
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.DEBUG if args.verbose else logging.INFO)
 
     script_dir = Path(args.directory)
     if not script_dir.is_dir():
         print(f"Error: Directory not found: {args.directory}")
         return 1 # Exit with error code
 
-    if args.dialect not in all_dialacts:
+    if args.dialect not in _all_dialects():
          print(f"Warning: Unknown dialect '{args.dialect}'. Using default '{DEFAULT_SQL_DIALECT}'.")
-         print(f"Available dialects: {', '.join(all_dialacts)}")
+         print(f"Available dialects: {', '.join(_all_dialects())}")
          args.dialect = DEFAULT_SQL_DIALECT
 
 
@@ -513,6 +661,7 @@ def main():
     print(f"Using SQL dialect: {args.dialect}")
 
     final_schema = process_sql_scripts(script_dir, args.dialect)
+    # Render each format once; the console and the output file both use the same string
     schema_output = format_schema_output(final_schema)
     print("\n" + schema_output) # Print to console
 
@@ -531,7 +680,8 @@ def main():
     if args.output:
         output_file = Path(args.output)
         try:
-            output_file.write_text(schema_output, encoding='utf-8')
+            # The output is fully rendered before the file is opened, so a formatter error never leaves a truncated file
+            output_file.write_bytes(schema_output.encode('utf-8')) # Encode once, skipping the text-mode wrapper
             print(f"\nSchema also written to: {output_file.resolve()}")
         except IOError as e:
             print(f"\nError writing schema to file {args.output}: {e}")
@@ -540,5 +690,4 @@ def main():
     return 0 # Exit successfully
 
 if __name__ == "__main__":
-    import sys
     sys.exit(main())
\ No newline at end of file
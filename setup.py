@@ -6,7 +6,6 @@ setup(
     py_modules=['dbviz'],  # Ensure this matches the name of your Python file without the .py extension
     packages=find_packages(),
     install_requires=[
-        'sqlparse',
         'setuptools'
     ],
     entry_points={